@@ -1,10 +1,9 @@
 import numpy as np
 import gpflow
 import tensorflow as tf
-import tensorflow_probability as tfp
 
 
-def fourier_features(X, W, b):
+def fourier_features(X, W, b, unscaled=False):
     """
     Given sampled tensors W and b, construct Fourier features of X. We do not take into account the normalizing constant
     alpha in this method as it is only used for optimization, and the constant does not affect the location of the
@@ -12,22 +11,29 @@ def fourier_features(X, W, b):
     :param X: tensor of shape (count, n, d)
     :param W: tensor of shape (count, D, d)
     :param b: tensor of shape (count, D, 1)
-    :param kernel: gpflow kernel
+    :param unscaled: if True, skip the sqrt(2 / D) scaling as well. Callers can absorb the constant
+    into theta once instead of paying an elementwise multiply over (count, n, D) per call
     :return: tensor of shape (count, n, D)
     """
     D = W.shape[1]
 
-    WX_b = W @ tf.linalg.matrix_transpose(X) + b  # (count, D, n)
-    return tf.cast(tf.sqrt(2.0 / D), dtype=tf.float64) * tf.cos(tf.linalg.matrix_transpose(WX_b))  # (count, n, D)
+    XW_b = tf.matmul(X, W, transpose_b=True) + tf.linalg.matrix_transpose(b)  # (count, n, D)
+    features = tf.cos(XW_b)  # (count, n, D)
+    if unscaled:
+        return features
+    return tf.cast(tf.sqrt(2.0 / D), dtype=X.dtype) * features
 
 
-def sample_fourier_features(X, kernel, D=100):
+def sample_fourier_features(X, kernel, D=100, count=None):
     """
     Fourier feature mapping of X for the RBF kernel
-    :param X: tensor of shape (count, n, d)
+    :param X: tensor of shape (count, n, d), or (1, n, d) to broadcast the same points against all
+    count feature samples
+    :param count: number of feature samples to draw. Defaults to the batch dimension of X
     :return: tensor of shape (count, n, D)
     """
-    count = X.shape[0]
+    if count is None:
+        count = X.shape[0]
     d = X.shape[2]
 
     if type(kernel) == gpflow.kernels.base.Product:  # For DTS implementation where we use a product of kernels
@@ -53,22 +59,22 @@ def sample_fourier_features(X, kernel, D=100):
     return fourier_features(X, W, b), W, b  # (count, n, D)
 
 
-def sample_theta_variational(phi, q_mu, q_sqrt):
+def sample_theta_variational(phi, q_mu, q_sqrt, standard_normal_samples=None):
     """
     Samples from distribution q(theta|D) = /int p(theta|y)p(y|f)q(f|D) df dy
     :param phi: Fourier features tensor with shape (count, n, D)
     :param q_mu: tensor of shape (n, 1)
     :param q_sqrt: tensor of shape (1, n, n). Lower triangular matrix
+    :param standard_normal_samples: optional tensor of shape (count, n) of standard normal draws.
+    Callers that retry on inversion failure can pass the same draws across attempts
     :return: tensor with shape (count, D, 1)
     """
     count = phi.shape[0]
     n = phi.shape[1]
     D = phi.shape[2]
 
-    standard_normal = tfp.distributions.MultivariateNormalDiag(
-            loc=tf.zeros(n, dtype=tf.float64),
-            scale_diag=tf.ones(n, dtype=tf.float64))
-    standard_normal_samples = standard_normal.sample(count)
+    if standard_normal_samples is None:
+        standard_normal_samples = tf.random.normal(shape=(count, n), dtype=tf.float64)
     # (count, n)
 
     q_samples = q_sqrt @ tf.expand_dims(standard_normal_samples, axis=-1) + q_mu
@@ -77,9 +83,17 @@ def sample_theta_variational(phi, q_mu, q_sqrt):
     transposed_phi = tf.linalg.matrix_transpose(phi)
     # (count, D, n)
 
-    transform_mat = tf.cond(n >= D,
-        true_fn = lambda : tf.linalg.inv(transposed_phi @ phi) @ transposed_phi,
-        false_fn = lambda: transposed_phi @ tf.linalg.inv(phi @ transposed_phi) ) # (count, D, n)
+    # n and D are static Python ints, so branch at graph construction time rather than with tf.cond.
+    # The Gram matrices are symmetric PSD, so solve with a Cholesky factorization instead of a general
+    # inverse; the diagonal jitter keeps the factorization from failing on near-singular matrices
+    if n >= D:
+        G = transposed_phi @ phi  # (count, D, D)
+        L = tf.linalg.cholesky(G + 1e-6 * tf.eye(D, dtype=tf.float64))
+        transform_mat = tf.linalg.cholesky_solve(L, transposed_phi)  # (count, D, n)
+    else:
+        G = phi @ transposed_phi  # (count, n, n)
+        L = tf.linalg.cholesky(G + 1e-6 * tf.eye(n, dtype=tf.float64))
+        transform_mat = tf.linalg.matrix_transpose(tf.linalg.cholesky_solve(L, phi))  # (count, D, n)
 
     theta = transform_mat @ q_samples
     # (count, D, 1)
@@ -87,26 +101,20 @@ def sample_theta_variational(phi, q_mu, q_sqrt):
     return theta
 
 
-def sample_features_weights(X, model, D):
-    # Ensure phi @ transposed_phi is invertible
-    invertible = False
-    fail_count = 0
-    while not invertible:
-        try:
-            phi, W, b = sample_fourier_features(X, model.kernel, D)  # phi has shape (count, n, D)
-            theta = sample_theta_variational(phi, model.q_mu, model.q_sqrt)
-            invertible = True
-        except tf.errors.InvalidArgumentError as err:  # this will be thrown if matrix inversion fails
-            print(err)
-            print("Resampling phi, W, b, theta")
-            fail_count += 1
-        if fail_count >= 100:
-            print("Retry limit exceeded")
-            raise ValueError("Failed")
+def sample_features_weights(X, model, D, count=None):
+    # The diagonal jitter in sample_theta_variational keeps the Cholesky factorization from failing
+    # on near-singular Gram matrices, so no resample-and-retry loop is needed
+    phi, W, b = sample_fourier_features(X, model.kernel, D, count)  # phi has shape (count, n, D)
+    theta = sample_theta_variational(phi, model.q_mu, model.q_sqrt)
 
     return phi, W, b, theta
 
 
+# x_star variables and their optimizers reused across sample_maximizers calls, keyed by
+# (count, n_init, d, min_val, max_val)
+_xstar_cache = {}
+
+
 def sample_maximizers(X, count, n_init, D, model, min_val, max_val, num_steps=3000):
     """
     Samples from the posterior over the global maximizer using the method by Shah & Ghahramani (2015). Approximates
@@ -126,44 +134,88 @@ def sample_maximizers(X, count, n_init, D, model, min_val, max_val, num_steps=30
     """
     d = X.shape[1]
 
-    X = tf.tile(tf.expand_dims(X, axis=0), [count, 1, 1])  # (count, n, d)
+    X = tf.expand_dims(X, axis=0)  # (1, n, d), broadcasts against the count batched W and b
 
-    phi, W, b, theta = sample_features_weights(X, model, D)
+    phi, W, b, theta = sample_features_weights(X, model, D, count)
+
+    # Freeze the sampled features and weights as constants with fixed shapes, so the compiled step
+    # below is traced once and its kernel reused for all num_steps iterations. The sqrt(2 / D)
+    # feature scaling is absorbed into theta here so the optimization loop can use unscaled features.
+    # The whole optimization path runs in float32: locating the argmax does not need float64
+    # precision, and float32 doubles the memory bandwidth (and much more on GPU compute)
+    W = tf.constant(tf.cast(W, dtype=tf.float32))
+    b = tf.constant(tf.cast(b, dtype=tf.float32))
+    theta = tf.constant(tf.cast(np.sqrt(2.0 / D) * theta, dtype=tf.float32))
+
+    # Appending b as an extra column of W and a ones column to x_star folds the bias add into the
+    # matmul, so each objective evaluation is a single matmul + cos instead of matmul + add + cos
+    W_aug = tf.concat([W, b], axis=-1)  # (count, D, d + 1)
+    theta_flat = tf.squeeze(theta, axis=-1)  # (count, D)
 
     def construct_maximizer_objective(x_star):
-        g = tf.reduce_mean(fourier_features(x_star, W, b) @ theta)
+        x_aug = tf.concat([x_star, tf.ones_like(x_star[..., :1])], axis=-1)  # (count, n_init, d + 1)
+        cos_features = tf.cos(tf.matmul(x_aug, W_aug, transpose_b=True))  # (count, n_init, D)
+        # einsum contracts the D axis in the same pass; under XLA the cos output is fused into the
+        # contraction instead of being materialized
+        g = tf.reduce_mean(tf.einsum('cnd,cd->cn', cos_features, theta_flat))
         return -g
 
-    # Compute x_star using gradient based methods
-    # optimizer = tf.keras.optimizers.Adam()
-    optimizer = tf.keras.optimizers.RMSprop(rho=0.0)
+    # Compute x_star using gradient based methods. The variable and optimizer are cached across
+    # calls with the same shape and bounds, so repeated calls reassign the existing device buffers
+    # instead of allocating fresh ones
+    cache_key = (count, n_init, d, min_val, max_val)
+    if cache_key not in _xstar_cache:
+        # optimizer = tf.keras.optimizers.Adam()
+        optimizer = tf.keras.optimizers.RMSprop(rho=0.0)
+        _xstar_cache[cache_key] = (tf.Variable(tf.zeros(shape=(count, n_init, d), dtype=tf.dtypes.float32),
+                                               constraint=lambda x: tf.clip_by_value(x, min_val, max_val)),
+                                   optimizer)
+    x_star, optimizer = _xstar_cache[cache_key]
+    x_star.assign(tf.random.uniform(shape=(count, n_init, d),
+                                    minval=min_val,
+                                    maxval=max_val,
+                                    dtype=tf.dtypes.float32))
+
+    # Compiling the step with XLA lets the matmul-cos-matmul chain fuse into a single kernel instead of
+    # materializing every intermediate tensor at each of the num_steps iterations
+    @tf.function(jit_compile=True)
+    def optimization_step():
+        with tf.GradientTape() as tape:
+            loss = construct_maximizer_objective(x_star)
+        grads = tape.gradient(loss, [x_star])
+        optimizer.apply_gradients(zip(grads, [x_star]))
+        return loss
+
+    # The recent losses live in a ring buffer on device, so the only host sync per check_interval
+    # steps is the scalar convergence bool. Testing the spread of the last few checked losses with a
+    # combined absolute/relative tolerance also avoids the old division by a possibly near-zero
+    # previous loss, which could stop the optimization spuriously
+    check_interval = 50
+    history_size = 4
+    atol = 1e-7
+    rtol = 1e-6
+    loss_history = tf.Variable(np.full(history_size, np.inf, dtype=np.float32), trainable=False)
+
+    @tf.function(jit_compile=True)
+    def convergence_check(current_loss):
+        loss_history.assign(tf.concat([loss_history[1:], [current_loss]], axis=0))
+        spread = tf.reduce_max(loss_history) - tf.reduce_min(loss_history)
+        return spread < atol + rtol * tf.abs(current_loss)
 
-    x_star = tf.Variable(tf.random.uniform(shape=(count, n_init, d),
-                                           minval=min_val,
-                                           maxval=max_val,
-                                           dtype=tf.dtypes.float64),
-                         constraint=lambda x: tf.clip_by_value(x, min_val, max_val))
-    loss = lambda: construct_maximizer_objective(x_star)
-
-    prev_loss = loss().numpy()
     for i in range(num_steps):
-        optimizer.minimize(loss, var_list=[x_star])
-        current_loss = loss().numpy()
+        current_loss = optimization_step()
         if i % 500 == 0:
-            print('Loss at step %s: %s' % (i, current_loss))
-        if abs((current_loss-prev_loss) / prev_loss) < 1e-7:
-            print('Loss at step %s: %s' % (i, current_loss))
-            break
-        prev_loss = current_loss
-
-    test = fourier_features(x_star, W, b) @ theta
-    print("test.shape = ", test.numpy().shape)
+            print('Loss at step %s: %s' % (i, current_loss.numpy()))
+        if i % check_interval == 0:
+            if convergence_check(current_loss).numpy():
+                print('Loss at step %s: %s' % (i, current_loss.numpy()))
+                break
 
-    fvals = tf.squeeze(fourier_features(x_star, W, b) @ theta, axis=2)
+    fvals = tf.squeeze(fourier_features(x_star, W, b, unscaled=True) @ theta, axis=2)
     # (count, n_init)
     max_idxs = tf.transpose(tf.stack([tf.range(count, dtype=tf.int64),
                          tf.math.argmax(fvals, axis=1)]))
 
-    maximizers = tf.gather_nd(x_star, indices=max_idxs)
+    maximizers = tf.cast(tf.gather_nd(x_star, indices=max_idxs), dtype=tf.float64)
 
     return maximizers
@@ -9,7 +9,8 @@ def forrester(x):
     :return: tensor of shape (..., )
     """
     x0 = x[..., 0]
-    return (6 * x0 - 2) * (6 * x0 - 2) * np.sin(12 * x0 - 4)
+    t = 6 * x0 - 2
+    return t * t * np.sin(12 * x0 - 4)
 
 
 def six_hump_camel(x):
@@ -21,7 +22,22 @@ def six_hump_camel(x):
     """
     x1 = x[..., 0]
     x2 = x[..., 1]
-    return (4. - 2.1 * (x1 ** 2) + (1. / 3.) * (x1 ** 4)) * (x1 ** 2) + (x1 * x2) + (-4. + 4 * (x2 ** 2)) * (x2 ** 2)
+    x1_sq = x1 * x1
+    x2_sq = x2 * x2
+    return (4. - 2.1 * x1_sq + (1. / 3.) * x1_sq * x1_sq) * x1_sq + (x1 * x2) + (-4. + 4 * x2_sq) * x2_sq
+
+
+# Hartmann 3-D coefficients, built once at import time so hartmann3d does not reallocate them on
+# every call
+_HARTMANN3D_ALPHA = np.array([1., 1.2, 3.0, 3.2])
+_HARTMANN3D_A = np.ascontiguousarray([[3.0, 10, 30],
+                                      [0.1, 10, 35],
+                                      [3.0, 10, 30],
+                                      [0.1, 10, 35]])
+_HARTMANN3D_P = 0.0001 * np.ascontiguousarray([[3689, 1170, 2673],
+                                               [4699, 4387, 7470],
+                                               [1091, 8732, 5547],
+                                               [381, 5743, 8828]])
 
 
 def hartmann3d(x):
@@ -33,18 +49,30 @@ def hartmann3d(x):
     :param x: tensor of shape (..., 3), x in [0, 1] for all dimensions
     :return: tensor of shape (..., )
     """
-    alpha = np.array([1., 1.2, 3.0, 3.2])
-    A = np.array([[3.0, 10, 30],
-                  [0.1, 10, 35],
-                  [3.0, 10, 30],
-                  [0.1, 10, 35]])
-    P = 0.0001 * np.array([[3689, 1170, 2673],
-                           [4699, 4387, 7470],
-                           [1091, 8732, 5547],
-                           [381, 5743, 8828]])
+    diff = x[..., np.newaxis, :] - _HARTMANN3D_P  # broadcasts to (..., 4, 3) without materializing a repeat
+    return -np.sum(_HARTMANN3D_ALPHA * np.exp(-np.sum(_HARTMANN3D_A * diff * diff, axis=-1)), axis=-1)
+
+
+_cifar_table_cache = {}
 
-    x_repeat = np.repeat(np.expand_dims(x, axis=-2), 4, axis=-2)
-    return -np.sum(alpha * np.exp(-np.sum(A * ((x_repeat - P) ** 2), axis=-1)), axis=-1)
+
+def _cifar_lookup_table(embedding_to_class, class_to_fval):
+    """
+    Builds a sorted table from embedding bytes to fvals so cifar can resolve all points with one
+    vectorized searchsorted instead of per-point Python dict lookups. Cached per embedding dict.
+    :param embedding_to_class: dict from embedding bytes to int class
+    :param class_to_fval: dict from int class to float fval
+    :return: (sorted byte keys of shape (num_embeddings,), fvals of shape (num_embeddings,))
+    """
+    cache_key = id(embedding_to_class)
+    if cache_key not in _cifar_table_cache:
+        keys = np.stack([np.frombuffer(k, dtype=np.float64) for k in embedding_to_class.keys()])
+        fvals = np.array([class_to_fval[c] for c in embedding_to_class.values()], dtype=np.float64)
+        raw_keys = np.ascontiguousarray(keys).view(np.dtype((np.void, keys.shape[1] * keys.itemsize)))
+        raw_keys = raw_keys.ravel()
+        order = np.argsort(raw_keys)
+        _cifar_table_cache[cache_key] = (raw_keys[order], fvals[order])
+    return _cifar_table_cache[cache_key]
 
 
 def cifar(x, embedding_to_class):
@@ -69,16 +97,36 @@ def cifar(x, embedding_to_class):
                      7: 4.}  # smaller is more preferred
 
     shape = x.shape[:-1]
-    raveled = np.reshape(x, [-1, 2])
-    raveled_shape = raveled.shape[:-1]
-    raveled_fvals = np.zeros((raveled_shape[0], 1), dtype=np.float64)
+    raveled = np.ascontiguousarray(np.reshape(x, [-1, 2]), dtype=np.float64)
 
-    for i in range(raveled_shape[0]):
-        raveled_fvals[i] = class_to_fval[embedding_to_class[raveled[i].data.tobytes()]]
+    sorted_keys, sorted_fvals = _cifar_lookup_table(embedding_to_class, class_to_fval)
+    queries = raveled.view(np.dtype((np.void, 2 * raveled.itemsize))).ravel()
+    raveled_fvals = sorted_fvals[np.searchsorted(sorted_keys, queries)]
 
     return np.reshape(raveled_fvals, shape + (1,))
 
 
+_sushi_table_cache = {}
+
+
+def _sushi_lookup_table(feat_to_fval_dict):
+    """
+    Builds a sorted table from sushi feature bytes to fvals, analogous to _cifar_lookup_table, so sushi
+    can resolve all data points with one vectorized searchsorted. Cached per feature dict.
+    :param feat_to_fval_dict: dict from feature bytes to float fval
+    :return: (sorted byte keys of shape (num_data,), fvals of shape (num_data,))
+    """
+    cache_key = id(feat_to_fval_dict)
+    if cache_key not in _sushi_table_cache:
+        keys = np.stack([np.frombuffer(k, dtype=np.float64) for k in feat_to_fval_dict.keys()])
+        fvals = np.array(list(feat_to_fval_dict.values()), dtype=np.float64)
+        raw_keys = np.ascontiguousarray(keys).view(np.dtype((np.void, keys.shape[1] * keys.itemsize)))
+        raw_keys = raw_keys.ravel()
+        order = np.argsort(raw_keys)
+        _sushi_table_cache[cache_key] = (raw_keys[order], fvals[order])
+    return _sushi_table_cache[cache_key]
+
+
 def sushi(x, feat_to_fval_dict):
     """
     6-D test function over the Sushi dataset with the minor group feature removed (overlaps with major group).
@@ -89,12 +137,11 @@ def sushi(x, feat_to_fval_dict):
 
     input_dims = x.shape[-1]
     shape = x.shape[:-1]  # shape except last dim
-    raveled = np.reshape(x, [-1, input_dims])
-    raveled_shape = raveled.shape[:-1]
-    raveled_fvals = np.zeros((raveled_shape[0]), dtype=np.float64)
+    raveled = np.ascontiguousarray(np.reshape(x, [-1, input_dims]), dtype=np.float64)
 
-    for i in range(raveled_shape[0]):
-        raveled_fvals[i] = -feat_to_fval_dict[raveled[i].data.tobytes()]  # here smaller is more preferred
+    sorted_keys, sorted_fvals = _sushi_lookup_table(feat_to_fval_dict)
+    queries = raveled.view(np.dtype((np.void, input_dims * raveled.itemsize))).ravel()
+    raveled_fvals = -sorted_fvals[np.searchsorted(sorted_keys, queries)]  # here smaller is more preferred
 
     return np.reshape(raveled_fvals, shape)
 
@@ -121,5 +168,5 @@ def objective_get_y(x, objective):
     :return: tensor of shape (..., input_dims)
     """
     evals = objective(x)  # (..., num_choices)
-    indices = np.argmin(evals, axis=1)[:, np.newaxis, np.newaxis]  # (..., 1, 1)
-    return np.squeeze(np.take_along_axis(x, indices, axis=-2), axis=-2)
+    indices = np.argmin(evals, axis=-1)  # (..., )
+    return x[np.arange(x.shape[0]), indices]